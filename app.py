@@ -1,12 +1,240 @@
-from fastapi import FastAPI, UploadFile, File
-from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
-from paddleocr import PaddleOCR
-import shutil
+from contextlib import asynccontextmanager
+from typing import Optional
+import asyncio
+import gc
+import hashlib
+import io
 import os
+import threading
+import time
+import traceback
+
+
+def _default_cpu_threads():
+    """Split the CPUs available to this process evenly across Uvicorn workers."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    return max(1, cpus // max(1, workers))
+
+
+# Pin math-library thread pools before numpy / OpenCV / Paddle load them so
+# multiple workers do not oversubscribe the cores.
+CPU_THREADS = int(os.getenv("OCR_CPU_THREADS", str(_default_cpu_threads())))
+for _thread_var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(_thread_var, str(CPU_THREADS))
+
+# Opt-in: benchmark every cuDNN convolution algorithm instead of using the
+# heuristic pick. The search is cached per input shape, and detection and
+# recognition shapes vary per request, so it keeps adding latency spikes on
+# the request path. Leave it off until benchmarked for the workload.
+# Paddle reads these flags when it is imported.
+if os.getenv("OCR_CUDNN_EXHAUSTIVE", "0") == "1":
+    os.environ.setdefault("FLAGS_cudnn_exhaustive_search", "1")
+    os.environ.setdefault("FLAGS_conv_workspace_size_limit", "4096")
+
+from fastapi import FastAPI, UploadFile, File, Query, Header, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+from cachetools import LRUCache
+import cv2
+import numpy as np
 import paddle
+from PIL import Image
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
+# Inference backend configuration (override via environment)
+# High-performance inference is opt-in: PaddleX ships its GPU HPI packages for
+# CUDA 11.8 / cuDNN 8.9 only, not for the CUDA 12.6 base image used here.
+PADDLEOCR_HPI = os.getenv("PADDLEOCR_HPI", "0") == "1"
+PADDLEOCR_TENSORRT = os.getenv("PADDLEOCR_TENSORRT", "1") == "1"
+PADDLEOCR_PRECISION = os.getenv("PADDLEOCR_PRECISION", "fp16")
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "/app/cache")
+
+# Device facts do not change while the process runs, so probe the CUDA runtime once
+CUDA_COMPILED = paddle.is_compiled_with_cuda()
+CUDA_AVAILABLE = CUDA_COMPILED and paddle.device.cuda.device_count() > 0
+
+
+def _detect_device():
+    """Return the Paddle device inference runs on, e.g. 'gpu:0' or 'cpu'."""
+    if not CUDA_COMPILED:
+        return "cpu"
+    try:
+        device = paddle.device.get_device()
+    except Exception as device_error:
+        print(f"Device detection error: {device_error}")
+        return "unknown"
+    return device if device and 'gpu' in device.lower() else "cpu"
+
+
+def _gpu_arch_tag():
+    """Return e.g. 'sm75' for the first visible GPU, or 'cpu'."""
+    if not CUDA_AVAILABLE:
+        return "cpu"
+    try:
+        major, minor = paddle.device.cuda.get_device_capability()
+        return f"sm{major}{minor}"
+    except Exception:
+        return "gpu"
+
+
+# Models and serialized TensorRT engines live under a per-architecture cache
+# so an engine built on one GPU generation is never loaded on another.
+# This must be set before paddleocr (and paddlex) are imported.
+os.environ.setdefault("PADDLE_PDX_CACHE_HOME", os.path.join(OCR_CACHE_DIR, _gpu_arch_tag()))
+
+from paddleocr import PaddleOCR
+
+OCR_KWARGS = {"use_angle_cls": True, "lang": "en"}
+
+if not CUDA_AVAILABLE:
+    # CPU inference is sequential inside the predictor, so batching only
+    # multiplies arena allocations. Keep batches at 1 unless overridden.
+    OCR_KWARGS.update({
+        "rec_batch_num": int(os.getenv("OCR_REC_BATCH_NUM", "1")),
+        "cls_batch_num": 1,
+        # Cap the longer side; PaddleOCR 3.x defaults to "min", which enlarges images
+        "det_limit_side_len": 960,
+        "det_limit_type": "max",
+        "cpu_threads": CPU_THREADS,
+    })
+elif os.getenv("OCR_REC_BATCH_NUM"):
+    OCR_KWARGS["rec_batch_num"] = int(os.getenv("OCR_REC_BATCH_NUM"))
+
+
+def _backend_candidates():
+    """Yield (backend_name, extra_kwargs) from fastest to most compatible."""
+    if PADDLEOCR_HPI:
+        # High-performance inference auto-selects OpenVINO / ONNX Runtime / TensorRT
+        yield "high_performance_inference", {"enable_hpi": True, "precision": PADDLEOCR_PRECISION}
+    if PADDLEOCR_TENSORRT and CUDA_AVAILABLE:
+        # Paddle Inference with TensorRT subgraphs; engines are serialized to the cache on first build
+        yield "paddle_inference_tensorrt", {"use_tensorrt": True, "precision": PADDLEOCR_PRECISION}
+    yield "paddle_inference", {}
+
+
+def _hpi_backends(engine):
+    """Best-effort map of sub-model name to the backend HPI selected for it.
+
+    PaddleX picks OpenVINO / ONNX Runtime / TensorRT / Paddle per model at
+    construction time; this only reads that decision once per build.
+    """
+    pipeline = getattr(engine, "paddlex_pipeline", None)
+    # The auto-parallel wrapper keeps the real pipeline in _pipeline
+    pipeline = getattr(pipeline, "_pipeline", pipeline)
+    backends = {}
+    for name, model in (vars(pipeline).items() if pipeline is not None else ()):
+        infer = getattr(model, "infer", None)
+        backend = getattr(infer, "backend", None) or getattr(infer, "_backend", None)
+        if isinstance(backend, str):
+            backends[name] = backend
+    return backends
+
+
+def build_ocr(candidates=None):
+    """Create a PaddleOCR instance on the fastest backend that initializes.
+
+    Returns (engine, backend, extra_kwargs) so callers can rebuild on the same
+    backend later without retrying the ones that failed.
+    """
+    last_error = None
+    for backend, extra_kwargs in candidates or _backend_candidates():
+        try:
+            engine = PaddleOCR(**OCR_KWARGS, **extra_kwargs)
+            if extra_kwargs.get("enable_hpi"):
+                hpi_backends = _hpi_backends(engine)
+                if hpi_backends:
+                    print(f"High-performance inference backends: {hpi_backends}")
+                    backend = "hpi_" + "+".join(sorted(set(hpi_backends.values())))
+            print(f"✅ Inference backend: {backend} {extra_kwargs or ''}")
+            return engine, backend, extra_kwargs
+        except Exception as backend_error:
+            print(f"❌ Backend {backend} unavailable: {backend_error}")
+            last_error = backend_error
+    raise last_error
+
+
+# Model recycling to bound PaddleOCR's RSS growth (0 disables either trigger)
+OCR_RECYCLE_EVERY = int(os.getenv("OCR_RECYCLE_EVERY", "500"))
+OCR_RSS_LIMIT_MB = int(os.getenv("OCR_RSS_LIMIT_MB", "0"))
+# Allocators often keep freed memory, so RSS can stay above the limit after a
+# recycle; require this many images between RSS-triggered recycles.
+OCR_RECYCLE_MIN_IMAGES = int(os.getenv("OCR_RECYCLE_MIN_IMAGES", "100"))
+
+
+class RecyclingOCR:
+    """PaddleOCR wrapper that periodically rebuilds the underlying model.
+
+    PaddleOCR's resident memory grows monotonically in long-running
+    processes. After OCR_RECYCLE_EVERY images, or once RSS exceeds
+    OCR_RSS_LIMIT_MB, a fresh instance is built in a background thread and
+    swapped in, so in-flight requests keep using the old one meanwhile.
+    Rebuilds reuse the backend that succeeded at startup.
+    """
+
+    def __init__(self):
+        self._engine, self.backend, self._backend_kwargs = build_ocr()
+        self.device = _detect_device()
+        # Paddle predictors are not thread-safe, so every model call holds this lock
+        self._lock = threading.Lock()
+        self._count = 0
+        self._rebuilding = False
+
+    def predict(self, images, **kwargs):
+        with self._lock:
+            result = self._engine.predict(images, **kwargs)
+            self._count += len(images) if isinstance(images, list) else 1
+            if not self._rebuilding and self._should_recycle():
+                self._rebuilding = True
+                threading.Thread(target=self._rebuild, daemon=True).start()
+        return result
+
+    def _should_recycle(self):
+        if OCR_RECYCLE_EVERY > 0 and self._count >= OCR_RECYCLE_EVERY:
+            return True
+        if OCR_RSS_LIMIT_MB > 0 and psutil is not None and self._count >= OCR_RECYCLE_MIN_IMAGES:
+            return psutil.Process().memory_info().rss > OCR_RSS_LIMIT_MB * 1024 * 1024
+        return False
+
+    def _rebuild(self):
+        print(f"Recycling PaddleOCR after {self._count} images...")
+        try:
+            engine, backend, _ = build_ocr([(self.backend, self._backend_kwargs)])
+            # Warm up before the swap so no request pays for kernel selection;
+            # the new engine is not shared yet, so this needs no lock
+            engine.predict(np.zeros((64, 64, 3), np.uint8))
+        except Exception as rebuild_error:
+            print(f"❌ PaddleOCR recycle failed, keeping current instance: {rebuild_error}")
+            with self._lock:
+                self._count = 0
+                self._rebuilding = False
+            return
+
+        with self._lock:
+            old_engine, self._engine, self.backend = self._engine, engine, backend
+            self.device = _detect_device()
+            self._count = 0
+            self._rebuilding = False
+
+        del old_engine
+        gc.collect()
+        if CUDA_AVAILABLE:
+            paddle.device.cuda.empty_cache()
+        print("✅ PaddleOCR recycled")
 
-app = FastAPI(title="PaddleOCR Invoice API", version="1.0.0")
 
 # Initialize PaddleOCR with GPU fallback to CPU
 OCR_INITIALIZED = False
@@ -16,14 +244,14 @@ print("Initializing PaddleOCR...")
 try:
     # Try GPU first
     print("Attempting GPU initialization...")
-    ocr = PaddleOCR(use_angle_cls=True, lang='en')
+    ocr = RecyclingOCR()
     OCR_INITIALIZED = True
     print("✅ PaddleOCR initialized successfully with GPU")
 except Exception as gpu_error:
     print(f"❌ GPU initialization failed: {gpu_error}")
     print("Attempting CPU fallback...")
     try:
-        ocr = PaddleOCR(use_angle_cls=True, lang='en')
+        ocr = RecyclingOCR()
         OCR_INITIALIZED = True
         print("✅ PaddleOCR initialized successfully with CPU")
     except Exception as cpu_error:
@@ -32,6 +260,371 @@ except Exception as gpu_error:
         ocr = None
         print("❌ PaddleOCR service is NOT available")
 
+# Request batching (override via environment)
+OCR_MAX_BATCH = int(os.getenv("OCR_MAX_BATCH", "8"))
+OCR_MAX_WAIT_MS = int(os.getenv("OCR_MAX_WAIT_MS", "20"))
+OCR_QUEUE_SIZE = int(os.getenv("OCR_QUEUE_SIZE", "64"))
+
+# Longest image side handed to the model; larger uploads are downscaled first
+# (0 disables). The default matches PaddleOCR 3.x's own max_side_limit.
+OCR_MAX_SIDE = int(os.getenv("OCR_MAX_SIDE", "4000"))
+
+# Responses cached by upload content hash; OCR is deterministic for a fixed model (0 disables)
+OCR_RESULT_CACHE_SIZE = int(os.getenv("OCR_RESULT_CACHE_SIZE", "1024"))
+result_cache = LRUCache(maxsize=OCR_RESULT_CACHE_SIZE) if OCR_RESULT_CACHE_SIZE > 0 else None
+result_cache_lock = threading.Lock()
+result_cache_stats = {"hits": 0, "misses": 0}
+
+# Whether /ocr/ runs the text-line angle classifier unless ?rotate_correct= says otherwise
+OCR_ROTATE_CORRECT_DEFAULT = os.getenv("OCR_ROTATE_CORRECT_DEFAULT", "1") == "1"
+
+ocr_queue = None
+
+
+def content_hash(data):
+    """Hex digest identifying an upload; run off the event loop for large images."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def cache_get(key):
+    """Return the cached response for key, or None, recording the hit/miss."""
+    if result_cache is None:
+        return None
+    with result_cache_lock:
+        response_data = result_cache.get(key)
+        result_cache_stats["hits" if response_data is not None else "misses"] += 1
+    return response_data
+
+
+def cache_put(key, response_data):
+    if result_cache is None:
+        return
+    with result_cache_lock:
+        result_cache[key] = response_data
+
+
+# HTTP revalidation: clients resending an image they already have results for get a 304
+OCR_CACHE_MAX_AGE = int(os.getenv("OCR_CACHE_MAX_AGE", "3600"))
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value lists etag (strong or weak).
+
+    "*" is deliberately not honoured: it would answer 304 for images this
+    server has never processed, so the client would never get results.
+    """
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
+
+_REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+def _read_header(data):
+    """Return (format, longest_side) from the image header without decoding pixels."""
+    try:
+        with Image.open(io.BytesIO(data)) as header:
+            return header.format, max(header.size)
+    except Exception:
+        return None, None
+
+
+def decode_image(data):
+    """Decode raw upload bytes into a BGR ndarray capped at OCR_MAX_SIDE.
+
+    Large JPEGs are decoded directly at 1/2, 1/4 or 1/8 resolution (DCT
+    scaling) when that still leaves at least OCR_MAX_SIDE pixels, so their
+    full-resolution bitmap is never materialized. Other formats would be
+    decoded in full and shrunk with a linear filter that aliases thin text
+    strokes, so they are decoded normally and downscaled with INTER_AREA.
+
+    Returns (image, scale) where scale maps original pixel coordinates to the
+    returned image, or (None, 1.0) if the bytes cannot be decoded.
+    """
+    image_format, longest = _read_header(data) if OCR_MAX_SIDE > 0 else (None, None)
+    flag = cv2.IMREAD_COLOR
+    if image_format == "JPEG":
+        for factor, reduced_flag in _REDUCED_DECODE_FLAGS:
+            if longest // factor >= OCR_MAX_SIDE:
+                flag = reduced_flag
+                break
+
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    if img is None:
+        return None, 1.0
+
+    h, w = img.shape[:2]
+    if longest is None:
+        longest = max(h, w)
+    if OCR_MAX_SIDE <= 0 or longest <= OCR_MAX_SIDE:
+        return img, 1.0
+
+    resize = OCR_MAX_SIDE / max(h, w)
+    if resize < 1.0:
+        img = cv2.resize(img, None, fx=resize, fy=resize, interpolation=cv2.INTER_AREA)
+    return img, OCR_MAX_SIDE / longest
+
+
+def run_ocr_batch(images, rotate_correct):
+    """Run one batched inference and return one page result per image.
+
+    The angle classifier is toggled per call on the shared model, so skipping
+    it costs no extra weights in memory.
+    """
+    return ocr.predict(images, use_textline_orientation=rotate_correct)
+
+
+def _to_original_coords(boxes, scale):
+    """Cast boxes to int32 pixel coordinates of the original (unscaled) upload."""
+    boxes = np.asarray(boxes, dtype=np.float64)
+    if scale != 1.0:
+        boxes = np.rint(boxes / scale)
+    return boxes.astype(np.int32)
+
+
+def parse_ocr_result(page_result, scale=1.0):
+    """Parse a PaddleOCR 3.x result: dict-like with rec_texts / rec_polys / rec_scores."""
+    texts = page_result.get('rec_texts', [])
+    boxes = page_result.get('rec_polys', [])
+    scores = page_result.get('rec_scores', [])
+
+    # Coerce all boxes and scores in one numpy pass each; orjson
+    # serializes the resulting arrays without converting to lists
+    try:
+        box_list = _to_original_coords(boxes, scale)
+    except ValueError:
+        # Polygon boxes with differing point counts
+        box_list = [_to_original_coords(box, scale) for box in boxes]
+    # A missing score becomes NaN in the array; keep reporting it as 0.0
+    score_list = np.round(np.nan_to_num(np.asarray(scores, dtype=np.float64), nan=0.0), 3)
+
+    clean_results = []
+    for text, box_coords, confidence in zip(texts, box_list, score_list):
+        text = str(text)
+        if text.strip():
+            clean_results.append({
+                "text": text,
+                "confidence": confidence,
+                "bounding_box": box_coords
+            })
+    return clean_results
+
+
+def _fail_futures(futures, error):
+    for future in futures:
+        if not future.done():
+            future.set_exception(error)
+
+
+async def _run_batch(batch):
+    """Run one collected batch, grouped by angle-correction flag."""
+    groups = {}
+    for img, rotate_correct, future in batch:
+        groups.setdefault(rotate_correct, []).append((img, future))
+
+    for rotate_correct, group in groups.items():
+        futures = [future for _, future in group]
+        try:
+            images = [img for img, _ in group]
+            results = await run_in_threadpool(run_ocr_batch, images, rotate_correct)
+            if results is None or len(results) != len(group):
+                raise RuntimeError(
+                    f"OCR returned {0 if results is None else len(results)} results for {len(group)} images"
+                )
+        except Exception as batch_error:
+            _fail_futures(futures, batch_error)
+            continue
+
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+
+async def ocr_batch_worker():
+    """Drain the queue into batches of up to OCR_MAX_BATCH images.
+
+    A batch is dispatched when it is full or OCR_MAX_WAIT_MS after its first
+    image arrived, whichever comes first. Images that want angle correction
+    and images that do not are run as separate model calls. Every future
+    taken off the queue is resolved, even if the batch fails unexpectedly,
+    so no request waits forever on a dead worker.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await ocr_queue.get()]
+        try:
+            deadline = loop.time() + OCR_MAX_WAIT_MS / 1000
+            while len(batch) < OCR_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(ocr_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await _run_batch(batch)
+        except asyncio.CancelledError:
+            _fail_futures([future for *_, future in batch], RuntimeError("OCR service is shutting down"))
+            raise
+        except Exception as batch_error:
+            print(f"❌ OCR batch failed: {batch_error}")
+            _fail_futures([future for *_, future in batch], batch_error)
+
+
+# Startup GPU verification: paddle can report a GPU device while kernels
+# silently run on CPU (wrong paddlepaddle-gpu build, cuDNN mismatch, ...)
+OCR_REQUIRE_GPU = os.getenv("OCR_REQUIRE_GPU", "0") == "1"
+OCR_GPU_CHECK_MS = float(os.getenv("OCR_GPU_CHECK_MS", "200"))
+GPU_ACTUALLY_USED = None
+
+
+def _nvml_device_index():
+    """NVML ignores CUDA_VISIBLE_DEVICES, so map the first visible device back."""
+    visible = os.getenv("CUDA_VISIBLE_DEVICES", "").split(",")[0].strip()
+    if visible.isdigit():
+        return int(visible)
+    return int(ocr.device.split(":")[-1]) if ":" in ocr.device else 0
+
+
+def _parent_pid(pid):
+    """Parent PID of pid as seen in this PID namespace, or None if not visible."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            return int(stat.read().rsplit(")", 1)[1].split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _own_process_on_gpu(handle):
+    """True / False if this worker's presence on the GPU can be determined, else None.
+
+    Device utilization covers the whole GPU, so with several workers sharing
+    it another worker's activity could mask a worker that fell back to CPU.
+    NVML reports host PIDs, which do not match inside a container without
+    pid: host, so a missing PID only counts as False when a sibling worker
+    (same parent) is listed, proving the PID list is visible here.
+    """
+    try:
+        gpu_pids = {proc.pid for proc in pynvml.nvmlDeviceGetComputeRunningProcesses(handle)}
+    except pynvml.NVMLError as nvml_error:
+        print(f"GPU process query failed: {nvml_error}")
+        return None
+    if os.getpid() in gpu_pids:
+        return True
+    parent = os.getppid()
+    if parent > 1 and any(_parent_pid(pid) == parent for pid in gpu_pids):
+        return False
+    return None
+
+
+def _sample_gpu_utilization(stats, stop):
+    """Sample device utilization until stop is set."""
+    try:
+        pynvml.nvmlInit()
+        try:
+            handle = pynvml.nvmlDeviceGetHandleByIndex(_nvml_device_index())
+            while not stop.is_set():
+                stats["utilization"].append(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+                stop.wait(0.02)
+            stats["utilization"].append(pynvml.nvmlDeviceGetUtilizationRates(handle).gpu)
+            # Only multiple workers sharing a GPU can mask each other
+            if int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+                stats["own_process"] = _own_process_on_gpu(handle)
+        finally:
+            pynvml.nvmlShutdown()
+    except pynvml.NVMLError as nvml_error:
+        print(f"GPU utilization sampling failed: {nvml_error}")
+
+
+def verify_gpu():
+    """Time a 640x640 inference and sample GPU utilization while it runs.
+
+    Returns False when inference appears to have silently fallen back to CPU.
+    With NVML: this worker is provably absent from the device's compute
+    processes, or utilization stayed at 0%. Without NVML: slower than
+    OCR_GPU_CHECK_MS.
+    """
+    probe = np.zeros((640, 640, 3), np.uint8)
+    # The first call at this shape pays for algorithm search; time the second
+    ocr.predict(probe)
+
+    stats = {"utilization": [], "own_process": None}
+    stop = threading.Event()
+    sampler = None
+    if pynvml is not None:
+        sampler = threading.Thread(target=_sample_gpu_utilization, args=(stats, stop), daemon=True)
+        sampler.start()
+
+    try:
+        t0 = time.perf_counter()
+        ocr.predict(probe)
+        elapsed_ms = (time.perf_counter() - t0) * 1000
+    finally:
+        # Always stop the sampler so it shuts NVML down, even if inference failed
+        stop.set()
+        if sampler is not None:
+            sampler.join()
+
+    samples = stats["utilization"]
+    peak = max(samples) if samples else None
+    peak_text = f"{peak}%" if peak is not None else "unavailable"
+    print(f"GPU check: 640x640 inference took {elapsed_ms:.0f} ms, peak GPU utilization: {peak_text}, "
+          f"process on GPU: {stats['own_process']}")
+    if peak is not None:
+        return peak > 0 and stats["own_process"] is not False
+    return elapsed_ms < OCR_GPU_CHECK_MS
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global ocr_queue, GPU_ACTUALLY_USED
+    ocr_queue = asyncio.Queue(maxsize=OCR_QUEUE_SIZE)
+    if OCR_INITIALIZED:
+        # Pay for lazy kernel selection / autotuning before the first real request
+        print("Warming up PaddleOCR...")
+        await run_in_threadpool(ocr.predict, np.zeros((64, 64, 3), np.uint8))
+
+        try:
+            GPU_ACTUALLY_USED = 'gpu' in ocr.device and await run_in_threadpool(verify_gpu)
+        except Exception as check_error:
+            print(f"❌ GPU check failed: {check_error}")
+            GPU_ACTUALLY_USED = False
+        if CUDA_COMPILED and not GPU_ACTUALLY_USED:
+            print(f"⚠️  WARNING: Paddle is built with CUDA and reports device '{ocr.device}', "
+                  "but OCR inference is running on the CPU")
+
+    if OCR_REQUIRE_GPU and not GPU_ACTUALLY_USED:
+        raise RuntimeError("OCR_REQUIRE_GPU=1 but OCR inference is not running on a GPU")
+
+    worker = asyncio.create_task(ocr_batch_worker()) if OCR_INITIALIZED else None
+    yield
+    if worker is not None:
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+    # Fail requests still waiting in the queue instead of leaving them hanging
+    while not ocr_queue.empty():
+        *_, future = ocr_queue.get_nowait()
+        _fail_futures([future], RuntimeError("OCR service is shutting down"))
+
+
+# orjson serializes numpy arrays and scalars directly, so results need no per-value coercion
+app = FastAPI(
+    title="PaddleOCR Invoice API",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
@@ -42,26 +635,32 @@ async def health_check():
         "service": "PaddleOCR Invoice API",
         "version": "1.0.0",
         "paddleocr_initialized": OCR_INITIALIZED,
+        "inference_backend": ocr.backend if ocr is not None else None,
         "paddle_available": True
     }
 
     if not OCR_INITIALIZED:
         health_info["status"] = "degraded"
         health_info["error"] = "PaddleOCR not initialized - OCR functionality unavailable"
-        return JSONResponse(status_code=503, content=health_info)
+        return ORJSONResponse(status_code=503, content=health_info)
 
     try:
-        # Test paddle and CUDA availability
-        health_info["cuda_available"] = paddle.is_compiled_with_cuda()
-
-        try:
-            device = paddle.device.get_device()
-            health_info["current_device"] = device
-            health_info["using_gpu"] = device and 'gpu' in device.lower()
-        except Exception as device_error:
-            health_info["device_error"] = str(device_error)
-            health_info["current_device"] = "unknown"
-            health_info["using_gpu"] = False
+        # Device is detected once at model build time
+        health_info["cuda_available"] = CUDA_COMPILED
+        health_info["current_device"] = ocr.device
+        health_info["using_gpu"] = 'gpu' in ocr.device and GPU_ACTUALLY_USED is not False
+        health_info["gpu_actually_used"] = GPU_ACTUALLY_USED
+
+        if result_cache is not None:
+            with result_cache_lock:
+                lookups = result_cache_stats["hits"] + result_cache_stats["misses"]
+                health_info["result_cache"] = {
+                    "size": len(result_cache),
+                    "maxsize": result_cache.maxsize,
+                    "hits": result_cache_stats["hits"],
+                    "misses": result_cache_stats["misses"],
+                    "hit_rate": round(result_cache_stats["hits"] / lookups, 3) if lookups else 0.0
+                }
 
         # Test OCR with a simple check
         if ocr is not None:
@@ -76,13 +675,20 @@ async def health_check():
     except Exception as e:
         health_info["status"] = "unhealthy"
         health_info["error"] = str(e)
-        return JSONResponse(status_code=503, content=health_info)
+        return ORJSONResponse(status_code=503, content=health_info)
 
 @app.post("/ocr/")
-async def ocr_endpoint(file: UploadFile = File(...)):
+async def ocr_endpoint(
+    file: UploadFile = File(...),
+    rotate_correct: bool = Query(
+        OCR_ROTATE_CORRECT_DEFAULT,
+        description="Run the text-line angle classifier (disable for upright scans to save time)"
+    ),
+    if_none_match: Optional[str] = Header(None)
+):
     # Check if PaddleOCR is initialized
     if not OCR_INITIALIZED or ocr is None:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=503,
             content={
                 "error": "PaddleOCR service is not available",
@@ -92,7 +698,7 @@ async def ocr_endpoint(file: UploadFile = File(...)):
 
     # Validate file
     if not file.filename:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=400,
             content={
                 "error": "No file provided",
@@ -100,11 +706,11 @@ async def ocr_endpoint(file: UploadFile = File(...)):
             }
         )
 
-    # Save the uploaded image with its original extension
+    # Read and decode the uploaded image in memory
     try:
         ext = file.filename.split('.')[-1].lower()
         if ext not in ['jpg', 'jpeg', 'png', 'bmp', 'tiff', 'webp']:
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=400,
                 content={
                     "error": f"Unsupported file format: {ext}. Supported formats: jpg, jpeg, png, bmp, tiff, webp",
@@ -112,123 +718,72 @@ async def ocr_endpoint(file: UploadFile = File(...)):
                 }
             )
 
-        temp_path = f"temp_img.{ext}"
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        data = await file.read()
+        cache_key = f"{await run_in_threadpool(content_hash, data)}-{int(rotate_correct)}"
+        cache_headers = {
+            "ETag": f'"{cache_key}"',
+            "Cache-Control": f"private, max-age={OCR_CACHE_MAX_AGE}"
+        }
+        if etag_matches(if_none_match, cache_headers["ETag"]):
+            return Response(status_code=304, headers=cache_headers)
+
+        cached = cache_get(cache_key)
+        if cached is not None:
+            return ORJSONResponse(content=cached, headers=cache_headers)
+
+        img, scale = await run_in_threadpool(decode_image, data)
+        if img is None:
+            return ORJSONResponse(
+                status_code=400,
+                content={
+                    "error": "Failed to decode image",
+                    "success": False
+                }
+            )
 
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=500,
             content={
-                "error": f"Failed to save file: {str(e)}",
+                "error": f"Failed to read file: {str(e)}",
                 "success": False
             }
         )
 
     try:
-        # Run OCR
-        result = ocr.ocr(temp_path)
+        # Queue the image for the batch worker and wait for its result
+        future = asyncio.get_running_loop().create_future()
+        await ocr_queue.put((img, rotate_correct, future))
+        page_result = await future
 
         # Prepare clean results with text, confidence, and bounding boxes
-        clean_results = []
-
-        # Process OCR results
-        if result is None or len(result) == 0:
-            clean_results = []
-        elif isinstance(result, list):
-            # Handle PaddleOCR result format
-            for page_idx, page_result in enumerate(result):
-                if page_result is None:
-                    continue
-
-                if isinstance(page_result, list):
-                    # Traditional format: list of [box, (text, score)]
-                    for line in page_result:
-                        if isinstance(line, list) and len(line) == 2:
-                            box, text_info = line
-                            if isinstance(text_info, (list, tuple)) and len(text_info) >= 2:
-                                text = text_info[0] if text_info[0] else ""
-                                confidence = float(text_info[1]) if len(text_info) > 1 and text_info[1] is not None else 0.0
-
-                                if text.strip():  # Only add non-empty text
-                                    clean_results.append({
-                                        "text": str(text),
-                                        "confidence": round(confidence, 3),
-                                        "bounding_box": [[int(coord[0]), int(coord[1])] for coord in box]
-                                    })
-                elif hasattr(page_result, 'keys') or isinstance(page_result, dict):
-                    # New format: dictionary-like object
-                    try:
-                        # Convert to dict if it's an object with keys
-                        result_dict = dict(page_result) if hasattr(page_result, 'keys') else page_result
-
-                        texts = result_dict.get('rec_texts', [])
-                        boxes = result_dict.get('rec_polys', [])
-                        scores = result_dict.get('rec_scores', [])
-
-                        for i, text in enumerate(texts):
-                            if i < len(boxes) and i < len(scores) and str(text).strip():
-                                box_coords = boxes[i]
-                                if hasattr(box_coords, 'tolist'):
-                                    box_coords = box_coords.tolist()
-
-                                clean_results.append({
-                                    "text": str(text),
-                                    "confidence": round(float(scores[i]), 3) if scores[i] is not None else 0.0,
-                                    "bounding_box": [[int(coord[0]), int(coord[1])] for coord in box_coords]
-                                })
-                    except Exception as inner_e:
-                        print(f"Error processing dictionary result: {inner_e}")
-                        # Fallback: try to extract what we can
-                        try:
-                            if hasattr(page_result, '__dict__'):
-                                for attr_name in dir(page_result):
-                                    if not attr_name.startswith('_'):
-                                        attr_value = getattr(page_result, attr_name)
-                                        if attr_value and not callable(attr_value):
-                                            clean_results.append({
-                                                "text": f"{attr_name}: {str(attr_value)[:100]}",
-                                                "confidence": 0.5,
-                                                "bounding_box": []
-                                            })
-                        except:
-                            pass
-
-        # Detect which device was used
         try:
-            if paddle.is_compiled_with_cuda():
-                try:
-                    device = paddle.device.get_device()
-                    if device and 'gpu' in device.lower():
-                        device_used = device
-                    else:
-                        device_used = "cpu"
-                except:
-                    device_used = "gpu"  # Assume GPU if CUDA is available
-            else:
-                device_used = "cpu"
-        except Exception as device_error:
-            print(f"Device detection error: {device_error}")
-            device_used = "unknown"
-
-        # Clean up temp file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+            clean_results = parse_ocr_result(page_result, scale)
+        except Exception:
+            print("❌ Failed to parse OCR result:")
+            traceback.print_exc()
+            return ORJSONResponse(
+                status_code=500,
+                content={
+                    "error": "Failed to parse OCR result",
+                    "code": "OCR_RESULT_PARSE_FAILED",
+                    "success": False
+                }
+            )
 
         response_data = {
-            "device": device_used,
+            "device": ocr.device,
             "results": clean_results,
             "total_text_regions": len(clean_results),
+            "scale": round(scale, 6),
             "success": True
         }
+        cache_put(cache_key, response_data)
 
-        return JSONResponse(content=response_data)
+        return ORJSONResponse(content=response_data, headers=cache_headers)
 
     except Exception as e:
-        # Clean up temp file on error
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+        return ORJSONResponse(content={"error": str(e)}, status_code=500)
 
 
 
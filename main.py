@@ -0,0 +1,14 @@
+import os
+
+import uvicorn
+
+if __name__ == "__main__":
+    # Each worker loads its own PaddleOCR instance and warms it up in the app lifespan
+    uvicorn.run(
+        "app:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8080")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+    )